@@ -1,8 +1,28 @@
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
+import io
 import os
-import yfinance as yf
+import pandas as pd
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
\ No newline at end of file
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+
+def _quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+def copy_df_to_postgres(df: pd.DataFrame, table_name: str, engine=engine):
+    # COPY ... FROM STDIN streams the frame as CSV, skipping per-row dict/JSON building
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    columns = ", ".join(_quote_ident(c) for c in df.columns)
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(f"COPY {_quote_ident(table_name)} ({columns}) FROM STDIN WITH CSV", buf)
\ No newline at end of file
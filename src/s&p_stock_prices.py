@@ -1,6 +1,9 @@
+import io
+import json
+import time
+import lxml.html
 import pandas as pd 
-from yahoo_fin import stock_info as si
-from src.database import engine
+from src.database import copy_df_to_postgres
 import requests
 import yfinance as yf
 import os
@@ -14,37 +17,60 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+COPY_THRESHOLD = 1000  # above this many rows, bulk load via Postgres COPY instead of REST
+TICKER_CACHE_PATH = os.path.join(os.path.dirname(__file__), "sp500_tickers.json")
+TICKER_CACHE_SECONDS = 24 * 60 * 60
+
 def get_sp500_tickers():
+    # Reuse the list fetched in the last 24h instead of hitting Wikipedia every run
+    if os.path.exists(TICKER_CACHE_PATH) and time.time() - os.path.getmtime(TICKER_CACHE_PATH) < TICKER_CACHE_SECONDS:
+        with open(TICKER_CACHE_PATH) as f:
+            return json.load(f)
+
     url = "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies"
     headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7)"}
     response = requests.get(url, headers=headers)
-    tables = pd.read_html(response.text)
-    df = tables[0]
+    # Only parse the constituents table rather than every table on the page
+    root = lxml.html.fromstring(response.text)
+    table = root.xpath('//table[contains(@class, "wikitable")]')[0]
+    df = pd.read_html(io.StringIO(lxml.html.tostring(table, encoding="unicode")))[0]
     tickers = df['Symbol'].tolist()
     tickers = [t.replace(".", "-") for t in tickers]  
+
+    with open(TICKER_CACHE_PATH, "w") as f:
+        json.dump(tickers, f)
     return tickers
 
+def reduce_mem(df: pd.DataFrame) -> pd.DataFrame:
+    # int64 -> smallest int that fits (volume). Prices stay float64: float32 would
+    # corrupt the stored values and widen them when serialised back to text.
+    for col in df.select_dtypes(include="integer").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
 def fetch_multiple_stocks(tickers, period="5y"):
     data = yf.download(tickers, period=period, group_by='ticker', threads=True)
-    records = []
-    for ticker in tickers:
-        try:
-            df = data[ticker].reset_index()
-            df['ticker'] = ticker
-            df = df[['ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume']]
-            df.rename(columns={
-                'Date': 'date',
-                'Open': 'open',
-                'High': 'high',
-                'Low': 'low',
-                'Close': 'close',
-                'Volume': 'volume'
-            }, inplace=True)
-            records.append(df)
-        except Exception as e:
-            print(f"⚠️ Error processing {ticker}: {e}")
-    combined = pd.concat(records)
+    # One reshape of the (ticker, field) column MultiIndex into long format
+    combined = (
+        data.stack(level=0, future_stack=True)
+        .rename_axis(index=['date', 'ticker'], columns=None)
+        .reset_index()
+        .rename(columns={
+            'Open': 'open',
+            'High': 'high',
+            'Low': 'low',
+            'Close': 'close',
+            'Volume': 'volume'
+        })
+    )
+    combined = combined[['ticker', 'date', 'open', 'high', 'low', 'close', 'volume']]
     combined['date'] = pd.to_datetime(combined['date'])
+    # Arrow-backed columns: cheaper dedup hashing and to_csv handoff to COPY.
+    # convert_integer=False keeps float64 prices/volume as floats, and 'date' stays numpy
+    # datetime64, so the text written for COPY/REST is unchanged
+    combined = reduce_mem(combined)
+    arrow_cols = ['ticker', 'open', 'high', 'low', 'close', 'volume']
+    combined[arrow_cols] = combined[arrow_cols].convert_dtypes(dtype_backend="pyarrow", convert_integer=False)
     combined.drop_duplicates(subset=['ticker', 'date'], inplace=True)
     print(f"✅ Downloaded {len(combined)} rows for {len(tickers)} tickers")
     return combined
@@ -53,9 +79,21 @@ def upload_to_supabase(df: pd.DataFrame, table_name: str = "stock_prices"):
     if df.empty:
         print("⚠️ No data to upload.")
         return
+
+    # Bulk loads go straight to Postgres; REST is kept for small incremental updates
+    if len(df) > COPY_THRESHOLD:
+        copy_df_to_postgres(df, table_name)
+        print(f"✅ Copied {len(df)} rows to '{table_name}' via Postgres COPY.")
+        return
     
-    for col in df.select_dtypes(include=["datetime64[ns]", "datetimetz"]).columns:
-        df[col] = df[col].apply(lambda x: x.isoformat() if pd.notnull(x) else None)
+    for col in [c for c in df.columns if pd.api.types.is_datetime64_any_dtype(df[c])]:
+        ser = df[col]
+        if ser.dt.tz is not None:
+            # %z gives -0500; isoformat() gives -05:00
+            text = ser.dt.strftime("%Y-%m-%dT%H:%M:%S%z").str.replace(r"([+-]\d{2})(\d{2})$", r"\1:\2", regex=True)
+        else:
+            text = ser.dt.strftime("%Y-%m-%dT%H:%M:%S")
+        df[col] = text.astype(object).where(ser.notna(), None)
     
     data = df.to_dict(orient="records")
     for chunk_start in range(0, len(data), 500):
@@ -77,4 +115,4 @@ def batch_download_and_upload(all_tickers, batch_size=20):
 
 if __name__ == "__main__":
     all_tickers = get_sp500_tickers()
-    batch_download_and_upload(all_tickers, batch_size=10)
\ No newline at end of file
+    batch_download_and_upload(all_tickers, batch_size=20)
\ No newline at end of file
@@ -9,22 +9,26 @@ s&p_variables_upload.py
 - Upserts rows into Supabase table: S&P500_DCF_Variables
 
 Requirements (install in your venv):
-  pip install yfinance pandas numpy python-dotenv supabase requests lxml html5lib
+  pip install "yfinance>=1.7" curl_cffi pandas numpy python-dotenv supabase requests lxml html5lib
 """
 
 from __future__ import annotations
 
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import yfinance as yf
+from curl_cffi import requests as curl_requests
 from dotenv import load_dotenv
 from supabase import Client, create_client
+from yfinance.exceptions import YFRateLimitError
 
 # =========================
 # Config
@@ -33,33 +37,57 @@ from supabase import Client, create_client
 YEARS = [2024, 2023, 2022, 2021]
 TABLE_NAME = "S&P500_DCF_Variables"
 CSV_PATH = "SP500.csv"
-RATE_LIMIT_SECONDS = 0.4  # be gentle to Yahoo
-
-# Label aliases (lower-cased) for resilience to Yahoo index changes
-REV_ALIASES = ["total revenue", "revenue", "totalrevenue"]
-OI_ALIASES = ["operating income", "operatingincome", "ebit"]
-NI_ALIASES = ["net income", "netincome"]
-OCF_ALIASES = [
+RATE_LIMIT_SECONDS = 0.25 # min spacing between Yahoo HTTP requests, across all threads
+MAX_WORKERS = 8           # concurrent scraper threads (network-bound, GIL released)
+MAX_RETRIES = 4           # attempts per ticker when Yahoo answers 429
+BACKOFF_SECONDS = 2.0     # first retry delay; doubles on each attempt
+UPSERT_CHUNK_SIZE = 500   # rows per Supabase upsert request
+
+# Label aliases (lower-cased, matching _index_map keys) for resilience to Yahoo index changes
+REV_ALIASES = ("total revenue", "revenue", "totalrevenue")
+OI_ALIASES = ("operating income", "operatingincome", "ebit")
+NI_ALIASES = ("net income", "netincome")
+OCF_ALIASES = (
     "operating cash flow",
     "total cash from operating activities",
     "totalcashfromoperatingactivities",
-]
-CAPEX_ALIASES = [
+)
+CAPEX_ALIASES = (
     "capital expenditure",
     "capitalexpenditures",
     "investments in property plant and equipment",
-]
-FCF_ALIASES = ["free cash flow", "freecashflow"]
-DEBT_ALIASES = ["total debt", "long term debt", "longtermdebt", "short long term debt"]
-CASH_ALIASES = ["cash and cash equivalents", "cashandcashequivalents"]
-EQUITY_ALIASES = [
+)
+FCF_ALIASES = ("free cash flow", "freecashflow")
+DEBT_ALIASES = ("total debt", "long term debt", "longtermdebt", "short long term debt")
+CASH_ALIASES = ("cash and cash equivalents", "cashandcashequivalents")
+EQUITY_ALIASES = (
     "stockholders equity",
     "total stockholder equity",
     "totalstockholdersequity",
-]
-GROSS_PROFIT_ALIASES = ["gross profit", "grossprofit"]
-CUR_ASSETS_ALIASES   = ["total current assets", "current assets", "totalcurrentassets"]
-CUR_LIABS_ALIASES    = ["total current liabilities", "current liabilities", "totalcurrentliabilities"]
+)
+GROSS_PROFIT_ALIASES = ("gross profit", "grossprofit")
+CUR_ASSETS_ALIASES   = ("total current assets", "current assets", "totalcurrentassets")
+CUR_LIABS_ALIASES    = ("total current liabilities", "current liabilities", "totalcurrentliabilities")
+
+# Metrics pulled from each statement: {metric: aliases}
+INC_METRICS = {
+    "revenue": REV_ALIASES,
+    "operating_income": OI_ALIASES,
+    "net_income": NI_ALIASES,
+    "gross_profit": GROSS_PROFIT_ALIASES,
+}
+CF_METRICS = {
+    "operating_cash_flow": OCF_ALIASES,
+    "capital_expenditure": CAPEX_ALIASES,
+    "free_cash_flow": FCF_ALIASES,
+}
+BS_METRICS = {
+    "total_debt": DEBT_ALIASES,
+    "cash_and_equivalents": CASH_ALIASES,
+    "total_equity": EQUITY_ALIASES,
+    "current_assets": CUR_ASSETS_ALIASES,
+    "current_liabilities": CUR_LIABS_ALIASES,
+}
 
 # =========================
 # Env & Supabase
@@ -134,26 +162,76 @@ def load_universe(csv_path: str = CSV_PATH) -> pd.DataFrame:
 # yfinance helpers
 # =========================
 
+class RateLimiter:
+    """
+    Thread-safe limiter: callers of wait() are spaced at least `interval` seconds apart.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class ThrottledSession(curl_requests.Session):
+    """
+    curl_cffi session that passes every request (info, statements, crumb) through a
+    shared RateLimiter, so the cap holds per HTTP call rather than per ticker.
+    """
+
+    def __init__(self, limiter: RateLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        self.limiter.wait()
+        return super().request(*args, **kwargs)
+
+def build_session() -> ThrottledSession:
+    """
+    One keep-alive session for every yf.Ticker, so Yahoo's TLS handshakes are paid once
+    per connection instead of once per request. Chrome impersonation matches the
+    curl_cffi session yfinance would otherwise create for itself; 429s are left for
+    scrape_with_retry to handle rather than retried here.
+    """
+    return ThrottledSession(RateLimiter(RATE_LIMIT_SECONDS), impersonate="chrome")
+
+SESSION = build_session()
+
+# Let yfinance raise instead of logging and returning empty frames/dicts, so a 429
+# surfaces as YFRateLimitError rather than looking like missing datapoints
+yf.config.debug.hide_exceptions = False
+
 def _index_map(df: Optional[pd.DataFrame]) -> Dict[str, str]:
     if df is None or df.empty:
         return {}
     return {str(i).strip().lower(): i for i in df.index}
 
-def _get_row_value(df: Optional[pd.DataFrame], aliases: List[str], col_obj) -> Optional[float]:
-    if df is None or df.empty:
-        return None
+def _statement_values(
+    df: pd.DataFrame, metrics: Dict[str, Tuple[str, ...]], cols: List[object]
+) -> Dict[str, np.ndarray]:
+    """
+    Slice every metric row for the given period columns in one reindex.
+    Returns {metric: float array aligned with cols}; missing rows/cells are NaN.
+    """
     idx = _index_map(df)
-    for a in aliases:
-        key = a.lower()
-        if key in idx:
-            try:
-                val = df.loc[idx[key], col_obj]
-                if pd.isna(val):
-                    return None
-                return float(val)
-            except Exception:
-                return None
-    return None
+    labels = [next((idx[a] for a in aliases if a in idx), None) for aliases in metrics.values()]
+    # A duplicated label is ambiguous: drop every copy so it reads as NaN (missing)
+    if not df.index.is_unique:
+        df = df[~df.index.duplicated(keep=False)]
+    sub = df.reindex(index=labels, columns=cols)
+    values = sub.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    return dict(zip(metrics, values))
+
+def _opt(val: float) -> Optional[float]:
+    return None if np.isnan(val) else float(val)
 
 def _columns_by_year(df: Optional[pd.DataFrame]) -> Dict[int, object]:
     """
@@ -178,6 +256,7 @@ def extract_annuals(stock: yf.Ticker) -> Optional[Dict[str, float]]:
     missing in the three statements, return None (drop ticker).
     Now includes: gross profit, margins, current assets/liabilities/ratio, debt/equity.
     """
+    # Fetched on the calling worker thread so its curl handle (and connection) is reused
     inc = stock.financials
     bs  = stock.balance_sheet
     cf  = stock.cashflow
@@ -186,34 +265,36 @@ def extract_annuals(stock: yf.Ticker) -> Optional[Dict[str, float]]:
     bs_cols  = _columns_by_year(bs)
     cf_cols  = _columns_by_year(cf)
 
-    out: Dict[str, float] = {}
+    # Need every year in every statement, otherwise drop the ticker
+    if any(y not in cols for y in YEARS for cols in (inc_cols, bs_cols, cf_cols)):
+        return None
 
-    for y in YEARS:
-        col_i = inc_cols.get(y)
-        col_b = bs_cols.get(y)
-        col_c = cf_cols.get(y)
-        if col_i is None or col_b is None or col_c is None:
-            return None  # missing a statement for that year
+    inc_v = _statement_values(inc, INC_METRICS, [inc_cols[y] for y in YEARS])
+    bs_v  = _statement_values(bs,  BS_METRICS,  [bs_cols[y]  for y in YEARS])
+    cf_v  = _statement_values(cf,  CF_METRICS,  [cf_cols[y]  for y in YEARS])
+
+    out: Dict[str, float] = {}
 
+    for j, y in enumerate(YEARS):
         # Income statement
-        revenue = _get_row_value(inc, REV_ALIASES,          col_i)
-        op_inc  = _get_row_value(inc, OI_ALIASES,           col_i)
-        net_inc = _get_row_value(inc, NI_ALIASES,           col_i)
-        gross_p = _get_row_value(inc, GROSS_PROFIT_ALIASES, col_i)
+        revenue = _opt(inc_v["revenue"][j])
+        op_inc  = _opt(inc_v["operating_income"][j])
+        net_inc = _opt(inc_v["net_income"][j])
+        gross_p = _opt(inc_v["gross_profit"][j])
 
         # Cash flow
-        ocf  = _get_row_value(cf,  OCF_ALIASES,  col_c)
-        capx = _get_row_value(cf,  CAPEX_ALIASES, col_c)
-        fcf  = _get_row_value(cf,  FCF_ALIASES,   col_c)
+        ocf  = _opt(cf_v["operating_cash_flow"][j])
+        capx = _opt(cf_v["capital_expenditure"][j])
+        fcf  = _opt(cf_v["free_cash_flow"][j])
         if fcf is None and (ocf is not None and capx is not None):
             fcf = ocf + capx  # CapEx usually negative
 
         # Balance sheet
-        debt = _get_row_value(bs,  DEBT_ALIASES,  col_b)
-        cash = _get_row_value(bs,  CASH_ALIASES,  col_b)
-        eqty = _get_row_value(bs,  EQUITY_ALIASES, col_b)
-        ca   = _get_row_value(bs,  CUR_ASSETS_ALIASES,  col_b)
-        cl   = _get_row_value(bs,  CUR_LIABS_ALIASES,   col_b)
+        debt = _opt(bs_v["total_debt"][j])
+        cash = _opt(bs_v["cash_and_equivalents"][j])
+        eqty = _opt(bs_v["total_equity"][j])
+        ca   = _opt(bs_v["current_assets"][j])
+        cl   = _opt(bs_v["current_liabilities"][j])
 
         # Require base values
         base = {
@@ -261,32 +342,39 @@ def extract_annuals(stock: yf.Ticker) -> Optional[Dict[str, float]]:
     return out
 
 def scrape_company_row(ticker: str, company_name: str, sector: str) -> Optional[Dict[str, object]]:
-    stock = yf.Ticker(ticker)
+    stock = yf.Ticker(ticker, session=SESSION)
 
     # Point-in-time stats
     current_price = shares_out = market_cap = beta = tax_rate = None
     trailing_pe = forward_pe = p_pcf = None
 
-    try:
-        fi = stock.fast_info
-        current_price = fi.get("last_price") or fi.get("lastPrice")
-        shares_out    = fi.get("shares")
-        market_cap    = fi.get("market_cap")
-    except Exception:
-        pass
-
+    # .info (one quoteSummary call) covers everything fast_info does; only fall back to
+    # fast_info for the price/shares/cap fields when .info fails or omits them
     try:
         info = stock.info
-        current_price = current_price or info.get("currentPrice") or info.get("regularMarketPrice")
-        shares_out    = shares_out or info.get("sharesOutstanding")
-        market_cap    = market_cap or info.get("marketCap")
+        current_price = info.get("currentPrice") or info.get("regularMarketPrice")
+        shares_out    = info.get("sharesOutstanding")
+        market_cap    = info.get("marketCap")
         beta          = info.get("beta")
         tax_rate      = info.get("effectiveTaxRate")
         trailing_pe   = info.get("trailingPE")
         forward_pe    = info.get("forwardPE")
+    except YFRateLimitError:
+        raise
     except Exception:
         pass
 
+    if not (current_price and shares_out and market_cap):
+        try:
+            fi = stock.fast_info
+            current_price = current_price or fi.get("last_price") or fi.get("lastPrice")
+            shares_out    = shares_out or fi.get("shares")
+            market_cap    = market_cap or fi.get("market_cap")
+        except YFRateLimitError:
+            raise
+        except Exception:
+            pass
+
     annuals = extract_annuals(stock)
     if annuals is None:
         return None
@@ -324,35 +412,48 @@ def scrape_company_row(ticker: str, company_name: str, sector: str) -> Optional[
         **annuals,
     }
 
-    # Enforce none-missing on core annuals + EPS only (P/E & P/PCF are optional)
-    required_keys = []
-    for y in YEARS:
-        required_keys += [
-            f"revenue_{y}", f"operating_income_{y}", f"net_income_{y}",
-            f"operating_cash_flow_{y}", f"capital_expenditure_{y}", f"free_cash_flow_{y}",
-            f"total_debt_{y}", f"cash_and_equivalents_{y}", f"total_equity_{y}",
-            f"gross_profit_{y}", f"gross_margin_{y}", f"operating_margin_{y}", f"net_margin_{y}",
-            f"fcf_margin_{y}", f"ofc_margin_{y}", f"debt_to_equity_{y}",
-            f"current_assets_{y}", f"current_liabilities_{y}", f"current_ratio_{y}",
-            f"eps_{y}"
-        ]
-    if any(row.get(k) is None for k in required_keys):
-        return None
-
     return row
 
+def scrape_with_retry(ticker: str, company_name: str, sector: str) -> Optional[Dict[str, object]]:
+    """
+    scrape_company_row with exponential backoff on Yahoo 429s.
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return scrape_company_row(ticker, company_name, sector)
+        except YFRateLimitError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+    return None
+
 # =========================
 # Supabase I/O
 # =========================
 
-def upsert_row(sb: Client, row: Dict[str, object]) -> bool:
+def _upsert_chunk(sb: Client, chunk: List[Dict[str, object]]) -> int:
+    """
+    Upsert one chunk; if PostgREST rejects it, split in halves so only the bad rows are lost.
+    """
     try:
         # Because ticker is PRIMARY KEY in the SQL we provided, upsert will replace/insert correctly
-        sb.table(TABLE_NAME).upsert(row).execute()
-        return True
+        sb.table(TABLE_NAME).upsert(chunk).execute()
+        return len(chunk)
     except Exception as e:
-        print(f"  ✗ Supabase upsert error for {row.get('ticker')}: {e}")
-        return False
+        if len(chunk) == 1:
+            print(f"  ✗ Supabase upsert error for {chunk[0].get('ticker')}: {e}")
+            return 0
+        mid = len(chunk) // 2
+        return _upsert_chunk(sb, chunk[:mid]) + _upsert_chunk(sb, chunk[mid:])
+
+def upsert_rows(sb: Client, rows: List[Dict[str, object]]) -> int:
+    """
+    Upsert rows in chunks of UPSERT_CHUNK_SIZE. Returns the number of rows written.
+    """
+    written = 0
+    for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        written += _upsert_chunk(sb, rows[i:i + UPSERT_CHUNK_SIZE])
+    return written
 
 # =========================
 # Main
@@ -368,35 +469,44 @@ def main():
     ok = 0
     skipped = 0
     failed = 0
+    buffer: List[Dict[str, object]] = []
 
-    for i, rec in enumerate(universe.to_dict(orient="records"), start=1):
-        t = rec["ticker"]
-        nm = rec["company_name"]
-        sc = rec["sector"]
-        print(f"\n[{i}/{len(universe)}] {t} — {nm} ({sc})")
+    def flush() -> None:
+        nonlocal ok, failed
+        if not buffer:
+            return
+        written = upsert_rows(sb, buffer)
+        ok += written
+        failed += len(buffer) - written
+        print(f"  ✓ Upserted {written}/{len(buffer)} rows")
+        buffer.clear()
 
+    recs = universe.to_dict(orient="records")
+
+    def work(rec: Dict[str, str]):
         try:
-            row = scrape_company_row(t, nm, sc)
+            return scrape_with_retry(rec["ticker"], rec["company_name"], rec["sector"]), None
         except Exception as e:
-            failed += 1
-            print(f"  ✗ Scrape error: {e}")
-            time.sleep(RATE_LIMIT_SECONDS)
-            continue
-
-        if row is None:
-            skipped += 1
-            print("  ↷ Skipped (missing one or more required datapoints for 2021–2024)")
-            time.sleep(RATE_LIMIT_SECONDS)
-            continue
-
-        if upsert_row(sb, row):
-            ok += 1
-            print("  ✓ Upserted")
-        else:
-            failed += 1
-            print("  ✗ Upload failed")
-
-        time.sleep(RATE_LIMIT_SECONDS)
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for i, (rec, (row, err)) in enumerate(zip(recs, executor.map(work, recs)), start=1):
+            print(f"\n[{i}/{len(recs)}] {rec['ticker']} — {rec['company_name']} ({rec['sector']})")
+
+            if err is not None:
+                failed += 1
+                print(f"  ✗ Scrape error: {err}")
+            elif row is None:
+                skipped += 1
+                print("  ↷ Skipped (missing one or more required datapoints for 2021–2024)")
+            else:
+                buffer.append(row)
+                print("  ✓ Scraped")
+
+            if len(buffer) >= UPSERT_CHUNK_SIZE:
+                flush()
+
+    flush()
 
     print("\n" + "=" * 60)
     print(f"Done. Upserted: {ok} | Skipped (incomplete): {skipped} | Failed: {failed}")